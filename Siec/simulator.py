@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 # vim:ts=4:sts=4:sw=4:expandtab
 
-import json
+import copy
+import itertools
 import logging
 import random
-import uuid
-import queue
+from collections import deque
 
 ###
 #
@@ -17,8 +17,10 @@ import time
 
 class Packet:
     """Abstract packet class"""
+    __slots__ = ('_id', '_src', '_dst')
+    _ids = itertools.count()
     def __init__(self, src, dst):
-        self._id  = uuid.uuid4()
+        self._id  = next(Packet._ids)
         self._src = src
         self._dst = dst
     @property
@@ -35,16 +37,24 @@ class Packet:
         return self._dst
 
 class MetaPacket(Packet):
-    """Packet for routing algorithm communication"""
-    def __init__(self, src, dst, payload):
+    """Packet for routing algorithm communication
+
+    With copy_payload=False the payload is stored by reference, so one
+    snapshot can be shared by all packets of a broadcast. Receivers must
+    not modify it."""
+    __slots__ = ('_payload',)
+    def __init__(self, src, dst, payload, copy_payload=True):
         super().__init__(src, dst)
-        self._payload = json.dumps(payload)
+        if copy_payload:
+            payload = copy.deepcopy(payload)
+        self._payload = payload
     @property
     def payload(self):
-        return json.loads(self._payload)
+        return self._payload
 
 class Link:
     """Abstract inter-router link class"""
+    __slots__ = ('_dst',)
     def __init__(self, dst):
         self._dst = dst
     @property
@@ -60,7 +70,10 @@ class Router:
         pass
     @property
     def links(self):
-        """Returns a list of links available at the router"""
+        """Returns an iterable of links available at the router"""
+        pass
+    def link_to(self, dst):
+        """Returns the link to the router dst or None"""
         pass
     @property
     def stored_packets(self):
@@ -83,13 +96,15 @@ class RoutingAlgorithm:
             raise ValueError
         self.router = router
     def __call__(self, packets):
-        if not isinstance(packets, list):
-            raise ValueError
-        for src, packet in packets:
-            if not isinstance(packet, Packet):
-                raise ValueError
-            if src is not None and not isinstance(src, Link):
-                raise ValueError
+        # packets may be any iterable; route() gets a list it can walk twice
+        packets = list(packets)
+        # type checks are skipped when running with python -O
+        if __debug__:
+            for src, packet in packets:
+                if not isinstance(packet, Packet):
+                    raise ValueError
+                if src is not None and not isinstance(src, Link):
+                    raise ValueError
         self.route(packets)
     def add_link(self, link):
         """Called when new link is added to router"""
@@ -109,12 +124,14 @@ class RoutingAlgorithm:
 class Simulator:
     """Simulator sandbox for routing algorithm experiments"""
     class SimPacket(Packet):
+        __slots__ = ('start_time', 'stop_time')
         def __init__(self, src, dst, start_time):
             super().__init__(src, dst)
             self.start_time = start_time
             self.stop_time = None
 
     class SimLink(Link):
+        __slots__ = ('packet',)
         def __init__(self, dst):
             super().__init__(dst)
             self.packet = None
@@ -122,16 +139,17 @@ class Simulator:
         def forward_packet(self, packet):
             if self.packet is not None:
                 raise RuntimeError
-            if not isinstance(packet, Packet):
-                raise ValueError
+            if __debug__:
+                if not isinstance(packet, Packet):
+                    raise ValueError
             self.packet = packet
 
     class SimRouter(Router):
-        def __init__(self, algorithm_class, id=None):
+        def __init__(self, algorithm_class, id):
             if not issubclass(algorithm_class, RoutingAlgorithm):
                 raise ValueError
             super().__init__()
-            self._id = id or uuid.uuid4()
+            self._id = id
             self._links = dict()
             self.store = dict()
             self.packets = dict()
@@ -142,46 +160,49 @@ class Simulator:
             return self._id
         @property
         def links(self):
-            return list(self._links.values())
+            return self._links.values()
+        def link_to(self, dst):
+            return self._links.get(dst)
         @property
         def stored_packets(self):
             return list(self.store.values())
 
         def drop_packet(self, packet):
-            if not isinstance(packet, Packet):
-                raise ValueError
-            if packet.id in self.store:
-                del self.store[packet.id]
-            if packet.id in self.packets:
-                del self.packets[packet.id]
-            logging.info("Droped packet [{}] {} -> {}".format(packet.id, packet.src, packet.dst))
+            if __debug__:
+                if not isinstance(packet, Packet):
+                    raise ValueError
+            self.store.pop(packet.id, None)
+            self.packets.pop(packet.id, None)
+            logging.info("Droped packet [%s] %s -> %s", packet.id, packet.src, packet.dst)
 
         def store_packet(self, packet):
-            if not isinstance(packet, Packet):
-                raise ValueError
+            if __debug__:
+                if not isinstance(packet, Packet):
+                    raise ValueError
             self.store[packet.id] = packet
-            if packet.id in self.packets:
-                del self.packets[packet.id]
+            self.packets.pop(packet.id, None)
 
         def forward_packet(self, link, packet):
-            if not isinstance(link, Simulator.SimLink):
-                raise ValueError
-            if not isinstance(packet, Packet):
-                raise ValueError
-            if link not in self.links:
+            if __debug__:
+                if not isinstance(link, Simulator.SimLink):
+                    raise ValueError
+                if not isinstance(packet, Packet):
+                    raise ValueError
+            if self._links.get(link.dst) is not link:
                 raise ValueError
             if isinstance(packet, Simulator.SimPacket):
                 if packet.id not in self.store and packet.id not in self.packets:
                     raise ValueError
             link.forward_packet(packet)
-            if packet.id in self.store:
-                del self.store[packet.id]
-            if packet.id in self.packets:
-                del self.packets[packet.id]
+            self.store.pop(packet.id, None)
+            self.packets.pop(packet.id, None)
 
     def __init__(self):
         self.routers = dict()
-        self.links = set()
+        # key((r1, r2) with r1 < r2):value((link r1 -> r2, link r2 -> r1))
+        self.links = dict()
+        # ids given to routers added without an explicit id
+        self._router_ids = itertools.count(1)
         self.time = 0
         self.routable_packets = 0
         self.routed_packets = list()
@@ -198,7 +219,14 @@ class Simulator:
         return response
 
     def add_router(self, algorithm_class, id=None):
-        if id in self.routers:
+        # Routers added without an id get the next free integer of this
+        # simulation. An explicit id already used, also a generated one,
+        # raises ValueError.
+        if id is None:
+            id = next(self._router_ids)
+            while id in self.routers:
+                id = next(self._router_ids)
+        elif id in self.routers:
             raise ValueError
         r = Simulator.SimRouter(algorithm_class, id)
         self.routers[r.id] = r
@@ -211,13 +239,16 @@ class Simulator:
             r2 = r2.id
         if r1 not in self.routers or r2 not in self.routers:
             raise ValueError
-        r1, r2 = (min(r1,r2), max(r1,r2))
+        if r1 > r2:
+            r1, r2 = r2, r1
         if r1 != r2 and (r1,r2) not in self.links:
-            self.links.add( (r1,r2) )
-            self.routers[r1]._links[r2] = Simulator.SimLink(r2)
-            self.routers[r1].algorithm.add_link(self.routers[r1]._links[r2])
-            self.routers[r2]._links[r1] = Simulator.SimLink(r1)
-            self.routers[r2].algorithm.add_link(self.routers[r2]._links[r1])
+            l1 = Simulator.SimLink(r2)
+            l2 = Simulator.SimLink(r1)
+            self.links[(r1,r2)] = (l1, l2)
+            self.routers[r1]._links[r2] = l1
+            self.routers[r1].algorithm.add_link(l1)
+            self.routers[r2]._links[r1] = l2
+            self.routers[r2].algorithm.add_link(l2)
 
     def del_link(self, r1, r2):
         if isinstance(r1, Router):
@@ -226,12 +257,13 @@ class Simulator:
             r2 = r2.id
         if r1 not in self.routers or r2 not in self.routers:
             raise ValueError
-        r1, r2 = (min(r1,r2), max(r1,r2))
+        if r1 > r2:
+            r1, r2 = r2, r1
         if (r1,r2) in self.links:
-            self.links.remove( (r1,r2) )
-            self.routers[r1].algorithm.del_link(self.routers[r1]._links[r2])
+            l1, l2 = self.links.pop( (r1,r2) )
+            self.routers[r1].algorithm.del_link(l1)
             del self.routers[r1]._links[r2]
-            self.routers[r2].algorithm.del_link(self.routers[r2]._links[r1])
+            self.routers[r2].algorithm.del_link(l2)
             del self.routers[r2]._links[r1]
 
     def add_packet(self, r1, r2):
@@ -249,25 +281,32 @@ class Simulator:
 
     def route(self):
         self.time += 1
-        for id, router in self.routers.items():
-            router.algorithm(list(router.packets.values()))
-            for src, packet in router.packets.values():
-                if packet.dst != router.id:
-                    logging.warning("Silently droped packet [{}] {} -> {} at {}".format(packet.id, packet.src, packet.dst, router.id))
-            router.packets = dict()
-        for id, router in self.routers.items():
+        routers = self.routers
+        # algorithms are called even without packets, since they keep
+        # their own clocks and broadcast periodically
+        for router in routers.values():
+            # __call__ copies the packets before route() changes router.packets
+            router.algorithm(router.packets.values())
+            if router.packets:
+                for src, packet in router.packets.values():
+                    if packet.dst != router.id:
+                        logging.warning("Silently droped packet [%s] %s -> %s at %s", packet.id, packet.src, packet.dst, router.id)
+                router.packets = dict()
+        for router in routers.values():
             for link in router.links:
-                if link.packet is not None:
-                    packet = link.packet
-                    link.packet = None
-                    if link.dst in self.routers:
-                        if isinstance(packet, Simulator.SimPacket) and packet.dst == link.dst:
-                            packet.stop_time = self.time
-                            self.routed_packets.append(packet)
-                            logging.info("Routed packet [{}] {} -> {} in {} steps".format(packet.id, packet.src, packet.dst, packet.stop_time - packet.start_time))
-                        else:
-                            logging.debug("Forwarded packet [{}] {} -> {} to {}".format(packet.id, packet.src, packet.dst, link.dst))
-                            self.routers[link.dst].packets[packet.id] = (self.routers[link.dst]._links[router.id], packet)
+                packet = link.packet
+                if packet is None:
+                    continue
+                link.packet = None
+                dst = routers.get(link.dst)
+                if dst is not None:
+                    if isinstance(packet, Simulator.SimPacket) and packet.dst == link.dst:
+                        packet.stop_time = self.time
+                        self.routed_packets.append(packet)
+                        logging.info("Routed packet [%s] %s -> %s in %s steps", packet.id, packet.src, packet.dst, packet.stop_time - packet.start_time)
+                    else:
+                        logging.debug("Forwarded packet [%s] %s -> %s to %s", packet.id, packet.src, packet.dst, link.dst)
+                        dst.packets[packet.id] = (dst.link_to(router.id), packet)
 
 ###
 #
@@ -281,12 +320,10 @@ class RandomRouter(RoutingAlgorithm):
             self.router.store_packet(packet)
         packets = self.router.stored_packets
         random.shuffle(packets)
-        links = self.router.links
+        links = list(self.router.links)
         random.shuffle(links)
-        for link in links:
-            if len(packets) > 0:
-                self.router.forward_packet(link, packets[-1])
-                packets = packets[0:-1]
+        for link, packet in zip(links, packets):
+            self.router.forward_packet(link, packet)
 
 class ShortPathRouter(RoutingAlgorithm):
     """Distance vector type routing algorithm"""
@@ -298,62 +335,87 @@ class ShortPathRouter(RoutingAlgorithm):
         self.distance_vec = dict()
         self.deleted = False
         self.last_delete = -1
+        # distance_vec changed since it was last sent to neighbours
+        self._dirty = True
+        # vectors are sent unconditionally until this tick after a delete
+        self._settle = 0
 
     @property
     def distance_vector(self):
         return self.distance_vec
 
     def route(self, packets):
-        for src, packet in packets:
+        # Delete epochs are applied first, with a single reset. Vectors that
+        # arrived before the newest epoch would be wiped by it, so they are
+        # not merged at all.
+        reset_at = -1
+        for i, (src, packet) in enumerate(packets):
+            if not isinstance(packet, MetaPacket):
+                continue
+            payload = packet.payload
+            if isinstance(payload, int):
+                self._settle = self.tick + 20
+                if payload > self.last_delete:
+                    self.last_delete = payload
+                    reset_at = i
+        if reset_at >= 0:
+            self.deleted = True
+            self._reset_from_links()
+            self._dirty = True
+
+        for i, (src, packet) in enumerate(packets):
             if isinstance(packet, MetaPacket):
+                payload = packet.payload
                 logging.debug(
-                    'Router {} received vector {} from {}'.format(self.router.id, packet.payload, src.dst))
-                if isinstance(packet.payload, int):
-                    if self.last_delete >= packet.payload:
-                        continue
-                    self.deleted = True
-                    self.last_delete = packet.payload
-                    self.distance_vec = dict()
-                    for link in self.router.links:
-                        self.distance_vec[link._dst] = (1, link._dst)
+                    'Router %s received vector %s from %s', self.router.id, payload, src.dst)
+                if isinstance(payload, int) or i < reset_at:
                     continue
-                for key, value in packet.payload.items():
+                for key, value in payload.items():
                     if key not in self.distance_vec or (value[0] + 1) < self.distance_vec[key][0]:
                         self.distance_vec[key] = (value[0] + 1, packet.src)
+                        self._dirty = True
             else:
                 self.router.store_packet(packet)
 
-        if self.tick % 5 == 0:
+        # unchanged vector is resent only every 10 ticks as a keepalive
+        if self.tick % 5 == 0 and (self.deleted or self._dirty or self.tick < self._settle or self.tick % 10 == 0):
             if self.deleted:
                 self.deleted = False
-                self.distance_vec = dict()
-                for link in self.router.links:
-                    self.distance_vec[link._dst] = (1, link._dst)
+                self._reset_from_links()
+                self._dirty = True
                 for link in self.router.links:
-                    self.router.forward_packet(link, MetaPacket(self.router.id, link.dst, self.last_delete))
+                    self.router.forward_packet(link, MetaPacket(self.router.id, link.dst, self.last_delete, copy_payload=False))
             else:
                 logging.debug(
-                    'Router {} sending vector {} to neighbors'.format(self.router.id, self.distance_vector))
+                    'Router %s sending vector %s to neighbors', self.router.id, self.distance_vector)
+                payload = copy.deepcopy(self.distance_vector)
                 for link in self.router.links:
-                    self.router.forward_packet(link, MetaPacket(self.router.id, link.dst, self.distance_vector))
+                    self.router.forward_packet(link, MetaPacket(self.router.id, link.dst, payload, copy_payload=False))
+                self._dirty = False
         else:
             for packet in self.router.stored_packets:
-                for link in self.router.links:
-                    if packet.dst in self.distance_vec and link.dst == self.distance_vec[packet.dst][1] and link.packet is None:
-                        self.router.forward_packet(link, packet)
-                        break
+                entry = self.distance_vec.get(packet.dst)
+                if entry is None:
+                    continue
+                link = self.router.link_to(entry[1])
+                if link is not None and link.packet is None:
+                    self.router.forward_packet(link, packet)
 
         self.tick += 1
 
     def add_link(self, link):
         self.distance_vec[link._dst] = (1, link._dst)
+        self._dirty = True
 
     def del_link(self, link):
         self.deleted = True
         self.last_delete = self.tick
-        self.distance_vec = dict()
-        for link in self.router.links:
-            self.distance_vec[link._dst] = (1, link._dst)
+        self._settle = self.tick + 20
+        self._reset_from_links()
+
+    def _reset_from_links(self):
+        """Forgets learned routes, keeping only direct neighbours"""
+        self.distance_vec = {l._dst: (1, l._dst) for l in self.router.links}
 
 class GraphRouting(RoutingAlgorithm):
     """Graph routing type routing algorithm"""
@@ -361,79 +423,93 @@ class GraphRouting(RoutingAlgorithm):
     def __init__(self, router):
         super().__init__(router)
         self.tick = 0
-        #key(vertex):value(key(vertex):value(time, is_existing))
+        #key((vertex, vertex)):value(time, is_existing)
         self.graph = dict()
+        #key(vertex):value(list of vertices with an edge in self.graph)
+        self.adj = dict()
         self.zmiana = False
+        # edges of self.graph updated since the last broadcast
+        self._delta = dict()
+        # next broadcast has to carry the whole graph
+        self._full = True
 
     def route(self, packets):
         for src, packet in packets:
             if isinstance(packet, MetaPacket):
                 logging.debug(
-                    'Router {} received vector {} from {}'.format(self.router.id, packet.payload, src.dst))
-                for v,x in packet.payload.items():
-                    for u,tup in x.items():
-                        if v not in self.graph:
-                            self.graph[v] = dict()
-                        elif u in self.graph[v] and self.graph[v][u][0] >= tup[0]:
-                            continue
-                        self.graph[v][u] = tup
-                        self.zmiana = True
+                    'Router %s received vector %s from %s', self.router.id, packet.payload, src.dst)
+                for edge, tup in packet.payload.items():
+                    cur = self.graph.get(edge)
+                    if cur is None or cur[0] < tup[0]:
+                        self._set_edge(edge, tup)
             else:
                 self.router.store_packet(packet)
         if self.zmiana or self.tick % 20 == 0:
+            # periodic full sync keeps routers converging if a delta was lost
+            if self._full or self.tick % 20 == 0:
+                # edges and values are tuples, so a shallow copy is a snapshot
+                payload = dict(self.graph)
+            else:
+                # self._delta is replaced below, never modified after sending
+                payload = self._delta
             for link in self.router.links:
-                self.router.forward_packet(link, MetaPacket(self.router.id, link.dst, self.graph))
+                self.router.forward_packet(link, MetaPacket(self.router.id, link.dst, payload, copy_payload=False))
             self.zmiana = False
+            self._delta = dict()
+            self._full = False
         else:
+            p = self._build_parents()
             for packet in self.router.stored_packets:
-                x = self.find_neighbour(packet.dst)
+                x = self.find_neighbour(packet.dst, p)
                 if x is not None:
                     self.router.forward_packet(x, packet)
+                    # x is busy now, so the parents have to be rebuilt
+                    p = self._build_parents()
         self.tick += 1
 
-    def find_neighbour(self, dst):
+    def _build_parents(self):
+        """Returns BFS parents of routers reachable through free links"""
         p = dict()
         p[self.router.id] = self.router.id
-        q = queue.Queue()
+        q = deque()
         for link in self.router.links:
             if link.packet is None:
                 p[link.dst] = self.router.id
-                q.put(link.dst)
-        while not q.empty():
-            v = q.get()
-            if v == dst:
-                break
-            if v not in self.graph:
+                q.append(link.dst)
+        while q:
+            v = q.popleft()
+            if v not in self.adj:
                 continue
-            for u,x in self.graph[v].items():
-                if u in p or not x[1]:
+            for u in self.adj[v]:
+                if u in p or not self.graph[(v,u)][1]:
                     continue
                 p[u] = v
-                q.put(u)
+                q.append(u)
+        return p
+
+    def find_neighbour(self, dst, p=None):
+        if p is None:
+            p = self._build_parents()
         if dst not in p:
             return None
         while p[dst] != self.router.id:
             dst = p[dst]
-        for link in self.router.links:
-            if link.dst == dst:
-                return link
-        return None
+        return self.router.link_to(dst)
 
-    def add_link(self, link):
-        v = self.router.id
-        u = link.dst
-        if v not in self.graph:
-            self.graph[v] = dict()
-        self.graph[v][u] = (self.tick, True)
+    def _set_edge(self, edge, tup):
+        if edge not in self.graph:
+            self.adj.setdefault(edge[0], list()).append(edge[1])
+        self.graph[edge] = tup
+        self._delta[edge] = tup
         self.zmiana = True
 
+    def add_link(self, link):
+        self._set_edge((self.router.id, link.dst), (self.tick, True))
+        # the new neighbour does not know the rest of the graph yet
+        self._full = True
+
     def del_link(self, link):
-        v = self.router.id
-        u = link.dst
-        if v not in self.graph:
-            self.graph[v] = dict()
-        self.graph[v][u] = (self.tick, False)
-        self.zmiana = True
+        self._set_edge((self.router.id, link.dst), (self.tick, False))
 
 ###
 #
@@ -562,9 +638,10 @@ def test4(algorithm):
             sim.add_link(r3, r4)
         sim.route()
 
-        for i in range(150):
-            sim.route()
-        print(sim.stats)
+    for i in range(150):
+        sim.route()
+    print(sim.stats)
+
 ###
 #
 # test functions with parametr - algoritm name (ShortPathRouter or GraphAlgoritm)